@@ -5,11 +5,11 @@ Classification evaluation.
 | `voxel51.com <https://voxel51.com/>`_
 |
 """
+from collections import OrderedDict
+from copy import deepcopy
 import itertools
 import warnings
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import numpy as np
 import sklearn.metrics as skm
 
@@ -19,6 +19,12 @@ from fiftyone.core.expressions import ViewField as F
 import fiftyone.core.fields as fof
 import fiftyone.core.utils as fou
 
+plt = fou.lazy_import("matplotlib.pyplot")
+mpl_axes_grid1 = fou.lazy_import("mpl_toolkits.axes_grid1")
+
+
+_MAX_CACHED_REPORTS = 4
+
 
 def evaluate_classifications(
     samples,
@@ -190,8 +196,11 @@ class SimpleEvaluation(ClassificationEvaluation):
         pred = pred_field + ".label"
         pred_conf = pred_field + ".confidence"
 
-        ytrue, ypred, confs = samples.aggregate(
-            [foa.Values(gt), foa.Values(pred), foa.Values(pred_conf)]
+        ytrue, ypred, confs = _aggregate_values(
+            samples,
+            pred_field,
+            gt_field,
+            [foa.Values(gt), foa.Values(pred), foa.Values(pred_conf)],
         )
 
         if is_frame_field:
@@ -212,19 +221,21 @@ class SimpleEvaluation(ClassificationEvaluation):
             pred = pred[len(samples._FRAMES_PREFIX) :]
 
             # Sample-level accuracies
-            samples._add_field_if_necessary(eval_key, fof.FloatField)
-            samples.set_field(
+            _save_field_if_changed(
+                samples,
                 eval_key,
+                fof.FloatField,
                 F("frames").map((F(gt) == F(pred)).to_double()).mean(),
-            ).save(eval_key)
+            )
 
             # Per-frame accuracies
             samples._add_field_if_necessary(eval_frame, fof.BooleanField)
             samples.set_field(eval_frame, F(gt) == F(pred)).save(eval_frame)
         else:
             # Per-sample accuracies
-            samples._add_field_if_necessary(eval_key, fof.BooleanField)
-            samples.set_field(eval_key, F(gt) == F(pred)).save(eval_key)
+            _save_field_if_changed(
+                samples, eval_key, fof.BooleanField, F(gt) == F(pred)
+            )
 
         return results
 
@@ -276,34 +287,48 @@ class TopKEvaluation(ClassificationEvaluation):
 
         # This extracts a potentially huge number of logits
         # @todo consider sample iteration for very large datasets
-        ytrue, ypred, logits = samples.aggregate(
+        ytrue, ypred, logits = _aggregate_values(
+            samples,
+            pred_field,
+            gt_field,
             [
                 foa.Values(gt_field + ".label"),
                 foa.Values(pred_field + ".label"),
                 foa.Values(pred_field + ".logits"),
-            ]
+            ],
         )
 
         targets_map = {label: idx for idx, label in enumerate(classes)}
 
         if is_frame_field:
-            confs = []
-            correct = []
-            for _ytrue, _ypred, _logits in zip(ytrue, ypred, logits):
-                _confs, _correct = _evaluate_top_k(
+            confs = [None] * len(ytrue)
+            correct = [None] * len(ytrue)
+            num_missing = 0
+            for idx, (_ytrue, _ypred, _logits) in enumerate(
+                zip(ytrue, ypred, logits)
+            ):
+                _confs, _correct, _num_missing = _evaluate_top_k(
                     _ytrue, _ypred, _logits, k, targets_map
                 )
-                confs.append(_confs)
-                correct.append(_correct)
+                confs[idx] = _confs
+                correct[idx] = _correct
+                num_missing += _num_missing
 
             ytrue = list(itertools.chain.from_iterable(ytrue))
             ypred = list(itertools.chain.from_iterable(ypred))
             confs = list(itertools.chain.from_iterable(confs))
         else:
-            confs, correct = _evaluate_top_k(
+            confs, correct, num_missing = _evaluate_top_k(
                 ytrue, ypred, logits, k, targets_map
             )
 
+        if num_missing > 0:
+            msg = (
+                "Found %d prediction(s) with no logits. Logits are required "
+                "to compute top-k accuracy" % num_missing
+            )
+            warnings.warn(msg)
+
         results = ClassificationResults(
             ytrue, ypred, confs, classes=classes, missing=missing
         )
@@ -330,41 +355,53 @@ class TopKEvaluation(ClassificationEvaluation):
 
 
 def _evaluate_top_k(ytrue, ypred, logits, k, targets_map):
-    confs = []
-    correct = []
-    for idx, (_ytrue, _logits) in enumerate(zip(ytrue, logits)):
+    num_samples = len(ytrue)
+    confs = [None] * num_samples
+    correct = [False] * num_samples
+
+    inds = []
+    for idx, _logits in enumerate(logits):
         if _logits is None:
             # No logits; no prediction
             ypred[idx] = None
-            _conf = None
-            _correct = False
-            msg = (
-                "Found sample(s) with no logits. Logits are required to "
-                + "compute top-k accuracy"
-            )
-            warnings.warn(msg)
         else:
-            target = targets_map[_ytrue]
-            top_k = np.argpartition(_logits, -k)[-k:]
-            if target in top_k:
-                # Truth is in top-k; use it
-                ypred[idx] = _ytrue
-                logit = _logits[target]
-                _correct = True
-            elif ypred[idx] is not None:
-                # Truth is not in top-k; retain actual prediction
-                logit = _logits[targets_map[ypred[idx]]]
-                _correct = False
-            else:
-                logit = -np.inf
-                _correct = False
+            inds.append(idx)
 
-            _conf = np.exp(logit) / np.sum(np.exp(_logits))
+    num_missing = num_samples - len(inds)
 
-        confs.append(_conf)
-        correct.append(_correct)
+    if not inds:
+        return confs, correct, num_missing
 
-    return confs, correct
+    _logits = np.asarray([logits[idx] for idx in inds], dtype=float)
+    targets = np.array([targets_map[ytrue[idx]] for idx in inds])
+    rows = np.arange(len(inds))
+
+    if k == 1:
+        in_top_k = _logits.argmax(axis=1) == targets
+    else:
+        top_k = np.argpartition(_logits, -k, axis=1)[:, -k:]
+        in_top_k = (top_k == targets[:, None]).any(axis=1)
+
+    # Truth in top-k: use it. Otherwise retain the actual prediction, if any
+    has_pred = np.array([ypred[idx] is not None for idx in inds], dtype=bool)
+    chosen = targets.copy()
+    for i in np.flatnonzero(~in_top_k & has_pred):
+        chosen[i] = targets_map[ypred[inds[i]]]
+
+    # Softmax of the chosen logits, via log-sum-exp for numerical stability
+    _max = _logits.max(axis=1)
+    lse = _max + np.log(np.exp(_logits - _max[:, None]).sum(axis=1))
+    _confs = np.exp(_logits[rows, chosen] - lse)
+    _confs[~in_top_k & ~has_pred] = 0.0
+
+    for i, idx in enumerate(inds):
+        if in_top_k[i]:
+            ypred[idx] = ytrue[idx]
+
+        confs[idx] = float(_confs[i])
+        correct[idx] = bool(in_top_k[i])
+
+    return confs, correct, num_missing
 
 
 class BinaryEvaluationConfig(ClassificationEvaluationConfig):
@@ -420,8 +457,11 @@ class BinaryEvaluation(ClassificationEvaluation):
         pred = pred_field + ".label"
         pred_conf = pred_field + ".confidence"
 
-        ytrue, ypred, confs = samples.aggregate(
-            [foa.Values(gt), foa.Values(pred), foa.Values(pred_conf)]
+        ytrue, ypred, confs = _aggregate_values(
+            samples,
+            pred_field,
+            gt_field,
+            [foa.Values(gt), foa.Values(pred), foa.Values(pred_conf)],
         )
 
         if is_frame_field:
@@ -440,43 +480,37 @@ class BinaryEvaluation(ClassificationEvaluation):
             pred = pred[len(samples._FRAMES_PREFIX) :]
 
             # Sample-level accuracies
-            samples._add_field_if_necessary(eval_key, fof.FloatField)
-            samples.set_field(
+            _save_field_if_changed(
+                samples,
                 eval_key,
+                fof.FloatField,
                 F("frames").map((F(gt) == F(pred)).to_double()).mean(),
-            ).save(eval_key)
+            )
 
             # Per-frame accuracies
             samples._add_field_if_necessary(eval_frame, fof.StringField)
             samples.set_field(
-                eval_frame,
-                F().switch(
-                    {
-                        (F(gt) == pos_label) & (F(pred) == pos_label): "TP",
-                        (F(gt) == pos_label) & (F(pred) != pos_label): "FN",
-                        (F(gt) != pos_label) & (F(pred) != pos_label): "TN",
-                        (F(gt) != pos_label) & (F(pred) == pos_label): "FP",
-                    }
-                ),
+                eval_frame, _to_binary_outcome(gt, pred, pos_label)
             ).save(eval_frame)
         else:
             # Per-sample accuracies
-            samples._add_field_if_necessary(eval_key, fof.StringField)
-            samples.set_field(
+            _save_field_if_changed(
+                samples,
                 eval_key,
-                F().switch(
-                    {
-                        (F(gt) == pos_label) & (F(pred) == pos_label): "TP",
-                        (F(gt) == pos_label) & (F(pred) != pos_label): "FN",
-                        (F(gt) != pos_label) & (F(pred) != pos_label): "TN",
-                        (F(gt) != pos_label) & (F(pred) == pos_label): "FP",
-                    }
-                ),
-            ).save(eval_key)
+                fof.StringField,
+                _to_binary_outcome(gt, pred, pos_label),
+            )
 
         return results
 
 
+def _to_binary_outcome(gt, pred, pos_label):
+    # Computes a 2-bit ``(is_gt_pos, is_pred_pos)`` index into the outcomes
+    # rather than evaluating a switch statement of four compound conditions
+    idx = 2 * (F(gt) == pos_label).to_int() + (F(pred) == pos_label).to_int()
+    return F.literal(["TN", "FP", "FN", "TP"])[idx]
+
+
 class ClassificationResults(foe.EvaluationResults):
     """Class that stores the results of a classification evaluation.
 
@@ -511,6 +545,32 @@ class ClassificationResults(foe.EvaluationResults):
         self.classes = np.asarray(classes)
         self.missing = missing
 
+        self._labels = None
+        self._reports = OrderedDict()
+
+        # Integer-encoded labels, which sklearn processes more efficiently.
+        # Observed labels that are not in `classes` are given extra indices
+        label_inds = {c: i for i, c in enumerate(classes)}
+        observed = set(itertools.chain(self.ytrue, self.ypred))
+        for label in observed.difference(label_inds):
+            label_inds[label] = len(label_inds)
+
+        self._label_inds = label_inds
+        self._ytrue_inds = _to_inds(self.ytrue, label_inds)
+        self._ypred_inds = _to_inds(self.ypred, label_inds)
+
+    def _get_label_inds(self, labels):
+        # Labels that never occur are given temporary indices that do not
+        # appear in the encoded ground truth/predictions
+        label_inds = self._label_inds
+        unknown = set(labels).difference(label_inds)
+        if unknown:
+            label_inds = dict(label_inds)
+            for label in unknown:
+                label_inds[label] = len(label_inds)
+
+        return _to_inds(labels, label_inds)
+
     def _get_labels(self, classes, include_missing=False):
         if classes is not None:
             return classes
@@ -518,7 +578,10 @@ class ClassificationResults(foe.EvaluationResults):
         if include_missing:
             return self.classes
 
-        return [c for c in self.classes if c != self.missing]
+        if self._labels is None:
+            self._labels = [c for c in self.classes if c != self.missing]
+
+        return self._labels
 
     def report(self, classes=None):
         """Generates a classification report for the results via
@@ -532,14 +595,7 @@ class ClassificationResults(foe.EvaluationResults):
             a dict
         """
         labels = self._get_labels(classes, include_missing=False)
-        return skm.classification_report(
-            self.ytrue,
-            self.ypred,
-            labels=labels,
-            sample_weight=self.weights,
-            output_dict=True,
-            zero_division=0,
-        )
+        return deepcopy(self._report(labels))
 
     def metrics(self, classes=None, average="micro", beta=1.0):
         """Computes classification metrics for the results, including accuracy,
@@ -561,8 +617,8 @@ class ClassificationResults(foe.EvaluationResults):
 
         try:
             accuracy = skm.accuracy_score(
-                self.ytrue,
-                self.ypred,
+                self._ytrue_inds,
+                self._ypred_inds,
                 normalize=True,
                 sample_weight=self.weights,
             )
@@ -570,10 +626,10 @@ class ClassificationResults(foe.EvaluationResults):
             accuracy = 0.0
 
         precision, recall, fscore, _ = skm.precision_recall_fscore_support(
-            self.ytrue,
-            self.ypred,
+            self._ytrue_inds,
+            self._ypred_inds,
             average=average,
-            labels=labels,
+            labels=self._get_label_inds(labels),
             beta=beta,
             sample_weight=self.weights,
             zero_division=0,
@@ -596,16 +652,34 @@ class ClassificationResults(foe.EvaluationResults):
             digits (2): the number of digits of precision to print
         """
         labels = self._get_labels(classes, include_missing=False)
-        report_str = skm.classification_report(
-            self.ytrue,
-            self.ypred,
-            labels=labels,
-            digits=digits,
-            sample_weight=self.weights,
-            zero_division=0,
+        report = self._report(labels)
+        report_str = _format_report(
+            report, digits=digits, weighted=self.weights is not None
         )
         print(report_str)
 
+    def _report(self, labels):
+        # Recently used reports are cached, up to `_MAX_CACHED_REPORTS`
+        key = tuple(labels)
+        report = self._reports.get(key, None)
+        if report is not None:
+            self._reports.move_to_end(key)
+        else:
+            report = skm.classification_report(
+                self._ytrue_inds,
+                self._ypred_inds,
+                labels=self._get_label_inds(labels),
+                target_names=["%s" % l for l in labels],
+                sample_weight=self.weights,
+                output_dict=True,
+                zero_division=0,
+            )
+            self._reports[key] = report
+            if len(self._reports) > _MAX_CACHED_REPORTS:
+                self._reports.popitem(last=False)
+
+        return report
+
     def confusion_matrix(self, classes=None, include_other=False):
         """Generates a confusion matrix for the results via
         ``sklearn.metrics.confusion_matrix``.
@@ -646,16 +720,26 @@ class ClassificationResults(foe.EvaluationResults):
         if include_missing and self.missing not in labels:
             labels.append(self.missing)
 
+        label_inds = self._get_label_inds(labels)
+
         if include_other:
-            labels_set = set(labels)
-            ypred = [y if y in labels_set else other_label for y in self.ypred]
-            ytrue = [y if y in labels_set else other_label for y in self.ytrue]
+            other_ind = label_inds[labels.index(other_label)]
+            ypred = np.where(
+                np.isin(self._ypred_inds, label_inds),
+                self._ypred_inds,
+                other_ind,
+            )
+            ytrue = np.where(
+                np.isin(self._ytrue_inds, label_inds),
+                self._ytrue_inds,
+                other_ind,
+            )
         else:
-            ypred = self.ypred
-            ytrue = self.ytrue
+            ypred = self._ypred_inds
+            ytrue = self._ytrue_inds
 
         confusion_matrix = skm.confusion_matrix(
-            ytrue, ypred, labels=labels, sample_weight=self.weights
+            ytrue, ypred, labels=label_inds, sample_weight=self.weights
         )
         return confusion_matrix, labels
 
@@ -912,6 +996,29 @@ def _parse_config(config, pred_field, gt_field, method, **kwargs):
     raise ValueError("Unsupported evaluation method '%s'" % method)
 
 
+def _aggregate_values(samples, pred_field, gt_field, aggregations):
+    # All aggregations are computed in a single pipeline. When evaluating
+    # sample-level fields, we first exclude all other fields so that only the
+    # relevant data is streamed through the pipeline
+    if not samples._is_frame_field(gt_field):
+        samples = samples.select_fields([gt_field, pred_field])
+
+    return samples.aggregate(aggregations)
+
+
+def _save_field_if_changed(samples, field, ftype, expr):
+    # When the field already exists, only samples whose value would change are
+    # written to the database, so re-running an evaluation on unchanged labels
+    # avoids a full write. New fields change on every sample, so the check is
+    # skipped to avoid evaluating `expr` twice
+    if samples.has_sample_field(field):
+        samples = samples.match(F(field) != expr)
+    else:
+        samples._add_field_if_necessary(field, ftype)
+
+    samples.set_field(field, expr).save(field)
+
+
 def _parse_labels(ytrue, ypred, classes, missing):
     if classes is None:
         classes = set(ytrue) | set(ypred)
@@ -931,29 +1038,92 @@ def _parse_labels(ytrue, ypred, classes, missing):
 
 
 def _clean_labels(y, missing):
-    found_missing = False
-
-    yclean = []
-    for yi in y:
-        if yi is None:
-            found_missing = True
-            yi = missing
+    y = np.array(y, dtype=object)
+    is_missing = np.equal(y, None)
+    found_missing = bool(is_missing.any())
+    y[is_missing] = missing
+    return y, found_missing
 
-        yclean.append(yi)
 
-    return yclean, found_missing
+def _to_inds(labels, label_inds):
+    return np.fromiter(
+        (label_inds[l] for l in labels), dtype=int, count=len(labels)
+    )
 
 
 def _to_binary_scores(y, confs, pos_label):
-    scores = []
-    for yi, conf in zip(y, confs):
-        if conf is None:
-            conf = 0.0
+    confs = np.array(confs, dtype=float)
+    confs[np.isnan(confs)] = 0.0
+    is_pos = np.asarray(y, dtype=object) == pos_label
+    return np.where(is_pos, confs, 1.0 - confs)
+
+
+def _format_report(report, digits=2, weighted=False):
+    # Reproduces the string format of ``sklearn.metrics.classification_report``
+    # from its ``output_dict=True`` form. Supports are printed as integer
+    # counts unless sample weights were used
+    def _support(support):
+        return support if weighted else int(support)
+
+    avg_names = [
+        n
+        for n in ("accuracy", "micro avg", "macro avg", "weighted avg")
+        if n in report
+    ]
+    class_names = [n for n in report.keys() if n not in avg_names]
+
+    headers = ["precision", "recall", "f1-score", "support"]
+    width = max([len(n) for n in class_names] + [len("weighted avg"), digits])
+
+    head_fmt = "{:>{width}s} " + " {:>9}" * len(headers)
+    row_fmt = "{:>{width}s} " + " {:>9.{digits}f}" * 3 + " {:>9}\n"
+    acc_fmt = (
+        "{:>{width}s} "
+        + " {:>9.{digits}}" * 2
+        + " {:>9.{digits}f}"
+        + " {:>9}\n"
+    )
+
+    report_str = head_fmt.format("", *headers, width=width) + "\n\n"
+
+    for name in class_names:
+        d = report[name]
+        report_str += row_fmt.format(
+            name,
+            d["precision"],
+            d["recall"],
+            d["f1-score"],
+            _support(d["support"]),
+            width=width,
+            digits=digits,
+        )
 
-        score = conf if yi == pos_label else 1.0 - conf
-        scores.append(score)
+    report_str += "\n"
+
+    for name in avg_names:
+        if name == "accuracy":
+            report_str += acc_fmt.format(
+                name,
+                "",
+                "",
+                report[name],
+                _support(report["macro avg"]["support"]),
+                width=width,
+                digits=digits,
+            )
+        else:
+            d = report[name]
+            report_str += row_fmt.format(
+                name,
+                d["precision"],
+                d["recall"],
+                d["f1-score"],
+                _support(d["support"]),
+                width=width,
+                digits=digits,
+            )
 
-    return scores
+    return report_str
 
 
 def _plot_confusion_matrix(
@@ -1010,7 +1180,7 @@ def _plot_confusion_matrix(
         plt.setp(ax.get_xticklabels(), rotation=xticks_rotation)
 
     if show_colorbar:
-        divider = make_axes_locatable(ax)
+        divider = mpl_axes_grid1.make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
         fig.colorbar(im, cax=cax)
 
@@ -8,7 +8,6 @@ COCO-style detection evaluation.
 import logging
 from collections import defaultdict
 
-import matplotlib.pyplot as plt
 import numpy as np
 import sklearn.metrics as skm
 
@@ -20,6 +19,8 @@ from .detection import (
     DetectionResults,
 )
 
+plt = fou.lazy_import("matplotlib.pyplot")
+
 
 logger = logging.getLogger(__name__)
 
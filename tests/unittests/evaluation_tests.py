@@ -0,0 +1,350 @@
+"""
+FiftyOne evaluation-related unit tests.
+
+| Copyright 2017-2021, Voxel51, Inc.
+| `voxel51.com <https://voxel51.com/>`_
+|
+"""
+import json
+import unittest
+import warnings
+
+import numpy as np
+import sklearn.metrics as skm
+
+import fiftyone as fo
+import fiftyone.utils.eval.classification as fouc
+
+from decorators import drop_datasets
+
+
+def _softmax(logits):
+    logits = np.asarray(logits, dtype=float)
+    return np.exp(logits) / np.sum(np.exp(logits))
+
+
+class TopKEvaluationTests(unittest.TestCase):
+    def setUp(self):
+        classes = ["a", "b", "c", "d"]
+        self.targets_map = {label: idx for idx, label in enumerate(classes)}
+
+        self.ytrue = ["a", "a", "d", "d", "b"]
+        self.ypred = ["b", "b", None, "a", "a"]
+        self.logits = [
+            None,  # no logits
+            [3.0, 2.0, 1.0, 0.0],
+            [3.0, 2.0, 1.0, 0.0],
+            [3.0, 2.0, 1.0, 0.0],
+            [1000.0, 999.0, -1000.0, 0.0],  # large-magnitude logits
+        ]
+
+    def _evaluate(self, k):
+        ypred = list(self.ypred)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            confs, correct, num_missing = fouc._evaluate_top_k(
+                self.ytrue, ypred, self.logits, k, self.targets_map
+            )
+
+        return confs, correct, ypred, num_missing
+
+    def test_top_k(self):
+        confs, correct, ypred, num_missing = self._evaluate(2)
+
+        self.assertEqual(num_missing, 1)
+        self.assertListEqual(correct, [False, True, False, False, True])
+        self.assertListEqual(ypred, [None, "a", None, "a", "b"])
+
+        # No logits
+        self.assertIsNone(confs[0])
+
+        # Truth in top-k
+        self.assertAlmostEqual(confs[1], _softmax(self.logits[1])[0])
+
+        # Truth not in top-k and no prediction
+        self.assertEqual(confs[2], 0.0)
+
+        # Truth not in top-k; actual prediction is retained
+        self.assertAlmostEqual(confs[3], _softmax(self.logits[3])[0])
+
+        # Large-magnitude logits do not overflow
+        self.assertAlmostEqual(confs[4], np.exp(-1) / (1 + np.exp(-1)))
+
+    def test_top_1(self):
+        confs, correct, ypred, num_missing = self._evaluate(1)
+
+        self.assertEqual(num_missing, 1)
+        self.assertListEqual(correct, [False, True, False, False, False])
+        self.assertListEqual(ypred, [None, "a", None, "a", "a"])
+
+        self.assertIsNone(confs[0])
+        self.assertAlmostEqual(confs[1], _softmax(self.logits[1])[0])
+        self.assertEqual(confs[2], 0.0)
+        self.assertAlmostEqual(confs[3], _softmax(self.logits[3])[0])
+        self.assertAlmostEqual(confs[4], 1 / (1 + np.exp(-1)))
+
+    def test_no_logits(self):
+        ypred = ["a", None]
+        confs, correct, num_missing = fouc._evaluate_top_k(
+            ["a", "b"], ypred, [None, None], 2, self.targets_map
+        )
+
+        self.assertEqual(num_missing, 2)
+        self.assertListEqual(confs, [None, None])
+        self.assertListEqual(correct, [False, False])
+        self.assertListEqual(ypred, [None, None])
+
+
+class ClassificationReportTests(unittest.TestCase):
+    def setUp(self):
+        self.ytrue = ["cat", "dog", "cat", "bird", "dog", "cat", "(none)"]
+        self.ypred = ["cat", "cat", "cat", "bird", "(none)", "dog", "dog"]
+
+    def _assert_report_matches(self, labels=None, weights=None, digits=2):
+        kwargs = dict(labels=labels, sample_weight=weights, zero_division=0)
+        report = skm.classification_report(
+            self.ytrue, self.ypred, output_dict=True, **kwargs
+        )
+        expected = skm.classification_report(
+            self.ytrue, self.ypred, digits=digits, **kwargs
+        )
+
+        report_str = fouc._format_report(
+            report, digits=digits, weighted=weights is not None
+        )
+        self.assertEqual(report_str, expected)
+
+    def test_default_labels(self):
+        self._assert_report_matches()
+
+    def test_labels_subset(self):
+        # An unseen label yields a "micro avg" row rather than "accuracy"
+        self._assert_report_matches(labels=["cat", "dog", "unicorn"])
+
+    def test_weights(self):
+        weights = [0.5, 1.25, 2.0, 0.75, 1.5, 0.1, 3.3]
+        self._assert_report_matches(weights=weights)
+        self._assert_report_matches(
+            labels=["cat", "dog", "unicorn"], weights=weights
+        )
+
+        # Integer-valued weights are still printed as weighted supports
+        self._assert_report_matches(weights=[10, 3, 7, 2, 1, 1, 4])
+
+    def test_digits(self):
+        self._assert_report_matches(digits=3)
+        self._assert_report_matches(labels=["cat", "unicorn"], digits=3)
+
+
+class ClassificationResultsTests(unittest.TestCase):
+    def test_unseen_labels(self):
+        results = fouc.ClassificationResults(
+            ["cat", "dog", "cat", None],
+            ["cat", "cat", "bird", "dog"],
+            classes=["cat", "dog"],
+        )
+        label_inds = dict(results._label_inds)
+
+        classes = ["cat", "unicorn"]
+        report = results.report(classes=classes)
+        self.assertListEqual(list(report.keys())[:2], ["cat", "unicorn"])
+        self.assertEqual(report["unicorn"]["support"], 0)
+
+        results.metrics(classes=classes)
+        cm, labels = results._confusion_matrix(
+            classes, include_other=True, other_label="(other)"
+        )
+        self.assertListEqual(labels, ["cat", "unicorn", "(other)"])
+        self.assertListEqual(cm.tolist(), [[1, 0, 1], [0, 0, 0], [1, 0, 1]])
+
+        # Queries must not modify the label encoding
+        self.assertDictEqual(results._label_inds, label_inds)
+
+    def test_report_cache(self):
+        results = fouc.ClassificationResults(
+            ["cat", "dog", "bird", "cat"], ["cat", "cat", "bird", "dog"],
+        )
+
+        default_report = results.report()
+        for classes in (["cat"], ["dog"], ["bird"], ["cat", "dog"]):
+            results.report(classes=classes)
+            results.report()  # keeps the default report cached
+
+        self.assertEqual(len(results._reports), fouc._MAX_CACHED_REPORTS)
+        self.assertDictEqual(results.report(), default_report)
+        self.assertIn(("cat", "dog"), results._reports)
+        self.assertNotIn(("cat",), results._reports)
+
+    def test_serialization(self):
+        results = fouc.ClassificationResults(
+            ["cat", "dog", "cat"],
+            ["cat", "cat", None],
+            confs=[0.9, 0.5, None],
+            weights=[1.0, 2.0, None],
+        )
+
+        def _raise(value):
+            raise ValueError("Invalid JSON constant '%s'" % value)
+
+        d = json.loads(results.to_str(), parse_constant=_raise)
+        self.assertListEqual(d["confs"], [0.9, 0.5, None])
+        self.assertListEqual(d["weights"], [1.0, 2.0, None])
+
+        results2 = fouc.ClassificationResults._from_dict(d, None)
+        self.assertListEqual(results2.ytrue.tolist(), results.ytrue.tolist())
+        self.assertListEqual(results2.ypred.tolist(), results.ypred.tolist())
+        self.assertListEqual(results2.confs.tolist(), [0.9, 0.5, None])
+        self.assertListEqual(results2.weights.tolist(), [1.0, 2.0, None])
+        self.assertListEqual(
+            results2.classes.tolist(), results.classes.tolist()
+        )
+
+
+class ClassificationEvaluationTests(unittest.TestCase):
+    def _make_classification(self, label):
+        if label is None:
+            return None
+
+        return fo.Classification(label=label, confidence=0.9)
+
+    @drop_datasets
+    def test_evaluate_rerun(self):
+        dataset = fo.Dataset()
+        for idx, (gt, pred) in enumerate(
+            [("cat", "cat"), ("dog", "cat"), ("bird", "bird")]
+        ):
+            sample = fo.Sample(filepath="image%d.jpg" % idx)
+            sample["ground_truth"] = self._make_classification(gt)
+            sample["predictions"] = self._make_classification(pred)
+            dataset.add_sample(sample)
+
+        dataset.evaluate_classifications(
+            "predictions", gt_field="ground_truth", eval_key="eval"
+        )
+        self.assertListEqual(dataset.values("eval"), [True, False, True])
+
+        sample = dataset.first()
+        sample["predictions"].label = "dog"
+        sample.save()
+
+        dataset.evaluate_classifications(
+            "predictions", gt_field="ground_truth", eval_key="eval"
+        )
+        self.assertListEqual(dataset.values("eval"), [False, False, True])
+
+    @drop_datasets
+    def test_evaluate_rerun_frames(self):
+        dataset = fo.Dataset()
+        for idx, frames in enumerate(
+            [
+                [("cat", "cat"), ("dog", "cat"), ("bird", "bird")],
+                [("cat", "dog"), ("dog", "dog")],
+            ]
+        ):
+            sample = fo.Sample(filepath="video%d.mp4" % idx)
+            for frame_number, (gt, pred) in enumerate(frames, 1):
+                frame = sample.frames[frame_number]
+                frame["ground_truth"] = self._make_classification(gt)
+                frame["predictions"] = self._make_classification(pred)
+
+            dataset.add_sample(sample)
+
+        dataset.evaluate_classifications(
+            "frames.predictions",
+            gt_field="frames.ground_truth",
+            eval_key="eval",
+        )
+        self.assertListEqual(
+            dataset.values("frames.eval"),
+            [[True, False, True], [False, True]],
+        )
+        self.assertListEqual(dataset.values("eval"), [2 / 3, 0.5])
+
+        sample = dataset.first()
+        sample.frames[2]["predictions"].label = "dog"
+        sample.save()
+
+        dataset.evaluate_classifications(
+            "frames.predictions",
+            gt_field="frames.ground_truth",
+            eval_key="eval",
+        )
+        self.assertListEqual(
+            dataset.values("frames.eval"),
+            [[True, True, True], [False, True]],
+        )
+        self.assertListEqual(dataset.values("eval"), [1.0, 0.5])
+
+    @drop_datasets
+    def test_evaluate_binary(self):
+        # (ground truth, prediction, expected outcome)
+        cases = [
+            ("pos", "pos", "TP"),
+            ("neg", "pos", "FP"),
+            ("pos", "neg", "FN"),
+            ("neg", "neg", "TN"),
+            ("pos", None, "FN"),  # missing prediction
+            (None, "pos", "FP"),  # missing ground truth
+            (None, None, "TN"),
+        ]
+
+        dataset = fo.Dataset()
+        for idx, (gt, pred, _) in enumerate(cases):
+            sample = fo.Sample(filepath="image%d.jpg" % idx)
+            sample["ground_truth"] = self._make_classification(gt)
+            sample["predictions"] = self._make_classification(pred)
+            dataset.add_sample(sample)
+
+        dataset.evaluate_classifications(
+            "predictions",
+            gt_field="ground_truth",
+            eval_key="eval",
+            method="binary",
+            classes=["neg", "pos"],
+        )
+
+        self.assertListEqual(
+            dataset.values("eval"), [outcome for _, _, outcome in cases]
+        )
+
+    @drop_datasets
+    def test_evaluate_binary_frames(self):
+        # (ground truth, prediction, expected outcome)
+        cases = [
+            ("pos", "pos", "TP"),
+            ("neg", "pos", "FP"),
+            ("pos", "neg", "FN"),
+            ("neg", "neg", "TN"),
+            ("pos", None, "FN"),  # missing prediction
+            (None, "pos", "FP"),  # missing ground truth
+        ]
+
+        dataset = fo.Dataset()
+        sample = fo.Sample(filepath="video.mp4")
+        for frame_number, (gt, pred, _) in enumerate(cases, 1):
+            frame = sample.frames[frame_number]
+            frame["ground_truth"] = self._make_classification(gt)
+            frame["predictions"] = self._make_classification(pred)
+
+        dataset.add_sample(sample)
+
+        dataset.evaluate_classifications(
+            "frames.predictions",
+            gt_field="frames.ground_truth",
+            eval_key="eval",
+            method="binary",
+            classes=["neg", "pos"],
+        )
+
+        self.assertListEqual(
+            dataset.values("frames.eval"),
+            [[outcome for _, _, outcome in cases]],
+        )
+
+        # Sample-level accuracy over the frames
+        self.assertListEqual(dataset.values("eval"), [2 / 6])
+
+
+if __name__ == "__main__":
+    fo.config.show_progress_bars = False
+    unittest.main(verbosity=2)